@@ -4,10 +4,18 @@
 # Written in 2024 by Mikhail Gribkov ( https://github.com/youzhick )
 # Distributed 'as is' with no license limitations.
 
+import bisect
+from contextlib import redirect_stdout
 import curses
 from datetime import datetime
+import fcntl
+import fnmatch
+import hashlib
+import io
 import os
+import re
 import sys
+import time
 
 KEY_UP = 259
 KEY_DOWN = 258
@@ -22,21 +30,28 @@ KEY_HOME = 262
 KEY_END = 360
 KEY_PGUP = 339
 KEY_PGDOWN = 338
+KEY_BACKSPACE = 263
 
 KEY_CTRL_SHIFT = -96
 
 KEYS_ENTER = [KEY_ENTER, KEY_PADENTER, 13, 343]
 KEYS_QUIT = [KEY_ESC, ord('c') + KEY_CTRL_SHIFT, ord('x') + KEY_CTRL_SHIFT, ord('q') + KEY_CTRL_SHIFT]
+KEYS_BACKSPACE = [KEY_BACKSPACE, 127, 8]
 SYMBOLS = [ord('_'), ord('-'), ord('+')]
 
 libNames = []
 includedLibs = []
+libSources = {} # lib name -> the dir it's loaded from
 
 libs_shared = ''
 libs_session = ''
 libs_local = ''
 
+dynamic_library_path = '$libdir'
+extension_control_path = '$system'
+
 lastFile = '~/.pglib.last'
+catalogFile = '~/.pglib.catalog'
 
 PGDATA = None
 PGINSTALL = None
@@ -47,12 +62,62 @@ postgresql_auto_conf = None
 libdir = None
 sharedir = None
 
+UI_FPS = 30
+UI_FPS_MAX = 240
+FRAME_STATS = False
+
+# Concurrent config writers: how many times to re-read and re-merge the file
+# if it was changed by someone else between reading and committing
+WRITE_RETRIES = 10
+WRITE_RETRY_DELAY = 0.05
+
+# Extension dirs scanning: max dirs scanned concurrently and how many names
+# are passed from a dir scanner at once
+SCAN_THREADS = 8
+SCAN_CHUNK = 256
+
 APP_VERSION = '1.0'
 # *************************************************************************
 # Returns timestamp in float seconds
 def getTimestamp():
     return datetime.now().timestamp()
 # *************************************************************************
+# Paces the UI repaints: at most one frame per 1/fps seconds.
+# Also keeps the frames statistics to make the rendering cost measurable.
+class FrameTimer:
+    def __init__(self, fps):
+        self.fps = max(fps, 1)
+        self.interval = 1. / self.fps
+        self.lastFrameStart = -1.
+        self.frameCount = 0
+        self.lastFrameTime = 0.
+        self.totalFrameTime = 0.
+        self.maxFrameTime = 0.
+
+    def frameDue(self):
+        return getTimestamp() >= self.lastFrameStart + self.interval
+
+    # Milliseconds to wait for the next frame (at least 1 to avoid busy looping)
+    def msToNextFrame(self):
+        left = self.lastFrameStart + self.interval - getTimestamp()
+        return max(int(left*1000), 1)
+
+    def beginFrame(self):
+        self.lastFrameStart = getTimestamp()
+
+    def endFrame(self):
+        self.lastFrameTime = getTimestamp() - self.lastFrameStart
+        self.totalFrameTime += self.lastFrameTime
+        self.maxFrameTime = max(self.maxFrameTime, self.lastFrameTime)
+        self.frameCount += 1
+
+    def avgFrameTime(self):
+        return self.totalFrameTime/self.frameCount if self.frameCount > 0 else 0.
+
+    def statsStr(self):
+        return ('Frames: ' + str(self.frameCount) + ' (cap ' + str(self.fps) + ' fps), render time last/avg/max: ' +
+                '%.1f/%.1f/%.1f ms' % (self.lastFrameTime*1000, self.avgFrameTime()*1000, self.maxFrameTime*1000))
+# *************************************************************************
 class PadComponent:
     def __init__(self, stdscr):
         self.stdscr = stdscr
@@ -80,13 +145,16 @@ class LinesSelectionPad(PadComponent):
         self.relayout(x, y, w)
         self.repaint()
         
-    def getCurLine(self):
-        if self.selected == 0:
+    def getLine(self, ind):
+        if ind == 0:
             return self.contents_shared
-        elif self.selected == 1:
+        elif ind == 1:
             return self.contents_session
         return self.contents_local
 
+    def getCurLine(self):
+        return self.getLine(self.selected)
+
     def setCurLine(self, newVal):
         if self.selected == 0:
             self.contents_shared = newVal
@@ -147,16 +215,69 @@ class LinesSelectionPad(PadComponent):
         
         self.setCurLine(ln)
         
+    def getCurTokens(self):
+        return [l.strip() for l in self.getCurLine().split(',')]
+
     def updateSelectedList(self):
         global libNames
         global includedLibs
         
-        ln = self.getCurLine()
-        tokens = [l.strip() for l in ln.split(',')]
+        tokens = self.getCurTokens()
         
         for i, l in enumerate(libNames):
             includedLibs[i] = l in tokens
             
+    # Batch update: applies the new inclusion flags for all the libs at once and
+    # rebuilds the current line a single time. The already listed libs keep their
+    # order (as well as the unknown ones), the newly included are added to the end.
+    def setInclusion(self, newIncluded):
+        global libNames
+        global includedLibs
+
+        newSet = set([l for l, inc in zip(libNames, newIncluded) if inc])
+        known = set(libNames)
+        tokens = [l.strip() for l in self.getCurLine().split(',') if len(l.strip()) > 0]
+
+        res = [t for t in tokens if t not in known or t in newSet]
+        listed = set(res)
+        for l in libNames:
+            if l in newSet and l not in listed:
+                res.append(l)
+                listed.add(l)
+
+        self.setCurLine(', '.join(res))
+        includedLibs[:] = newIncluded
+
+    # Pattern is a glob ('pg_stat*') or a regex between slashes ('/^pg_(stat|wait)/').
+    # Returns the number of libs changed or None if the pattern is invalid.
+    def includeByPattern(self, pattern, include):
+        global libNames
+        global includedLibs
+
+        pattern = pattern.strip()
+        if len(pattern) > 1 and pattern.startswith('/') and pattern.endswith('/'):
+            try:
+                isMatch = re.compile(pattern[1:-1]).search
+            except re.error:
+                return None
+        else:
+            # Glob matches the whole name
+            isMatch = re.compile(fnmatch.translate(pattern)).match
+
+        newIncluded = [include if isMatch(l) else inc for l, inc in zip(libNames, includedLibs)]
+        changed = sum([1 for a, b in zip(newIncluded, includedLibs) if a != b])
+        if changed > 0:
+            self.setInclusion(newIncluded)
+        return changed
+
+    def invertInclusion(self):
+        global includedLibs
+        self.setInclusion([not inc for inc in includedLibs])
+
+    def copyFrom(self, ind):
+        self.setCurLine(self.getLine(ind))
+        self.updateSelectedList()
+
     def saveFiles(self):
         global libs_shared
         global libs_session
@@ -166,7 +287,7 @@ class LinesSelectionPad(PadComponent):
         libs_session = self.contents_session
         libs_local = self.contents_local
 
-        saveCurrentConfigs()
+        return saveCurrentConfigs()
 # *************************************************************************
 class LibsPad(PadComponent):
     def __init__(self, stdscr, x, y, w, h):
@@ -174,6 +295,7 @@ class LibsPad(PadComponent):
         self.selColPair = 0
         self.selected = 0
         self.savedSelected = 0
+        self.cursorMoved = False
         self.relayout(x, y, w, h)
         self.repaint()
     
@@ -232,13 +354,40 @@ class LibsPad(PadComponent):
         libsCnt = len(libNames)
 
         if libsCnt > 0:
+            self.cursorMoved = True
             self.selected += dy + dx*self.height
             
             if self.selected < 0:
                 self.selected = 0
             elif self.selected >= libsCnt:
                 self.selected = libsCnt - 1
-                
+
+    def setSelection(self, ind):
+        self.cursorMoved = True
+        self.selected = ind
+
+    # Merges the newly discovered (name, lib dir) libs into the sorted list in place.
+    # Until the user moves the cursor it stays at the top of the list,
+    # after that it (and the quick search start) stays at the same lib.
+    def mergeLibs(self, libs, includedNames):
+        global libNames
+        global includedLibs
+        global libSources
+
+        for n, d in libs:
+            libSources[n] = d
+            i = bisect.bisect_left(libNames, n)
+            if i < len(libNames) and libNames[i] == n:
+                continue
+            hadLibs = len(libNames) > 0
+            libNames.insert(i, n)
+            includedLibs.insert(i, n in includedNames)
+            if self.cursorMoved and hadLibs:
+                if i <= self.selected:
+                    self.selected += 1
+                if i <= self.savedSelected:
+                    self.savedSelected += 1
+
     def switchInclusion(self):
         global includedLibs
 
@@ -258,7 +407,7 @@ class LibsPad(PadComponent):
                 realI = (i + self.savedSelected + 1) % libsCnt
                 s = libNames[realI].lower()
                 if s.find(qsStr) >= 0:
-                    self.selected = realI
+                    self.setSelection(realI)
                     break
         
 
@@ -292,7 +441,7 @@ class LabelPad(PadComponent):
         if instantRepaint:
             self.repaint()
 # *************************************************************************
-def win_main(stdscr):
+def win_main(stdscr, loader=None):
     global libNames
 
     curses.init_color(curses.COLOR_YELLOW, 1000, 1000, 0)
@@ -307,6 +456,7 @@ def win_main(stdscr):
     stdscr.refresh()
 
     savedStr = '--== Saved ==--'
+    saveFailedStr = '--== Save failed ==--'
     lbSaved = LabelPad(stdscr, w - 3 - len(savedStr), h - 4, len(savedStr), isCentered=True, bgChar=' ')
     lbSaved.setColorPair(4)
     lbSaved.setText(savedStr)
@@ -322,7 +472,7 @@ def win_main(stdscr):
 
     lbHeadLibs = LabelPad(stdscr, 0, 4, w, isCentered=True, bgChar='=')
     lbHeadLibs.setColorPair(1)
-    lbHeadLibs.setText('_Libraries_')
+    lbHeadLibs.setText('_Libraries_' if loader is None else '_Libraries_(scanning...)_')
     lbHeadLibs.repaint()
 
     libsPad = LibsPad(stdscr, 0, 5, w, h - 6)
@@ -332,10 +482,21 @@ def win_main(stdscr):
 
     lbHelp = LabelPad(stdscr, 0, h-1, w, isCentered=False, bgChar=' ')
     lbHelp.setColorPair(1)
-    lbHelp.setText('^S: Save    ^Q/^X: Quit    ^R: Reset    ENTER/SPACE: Select    TAB: Switch Constant    Arrows: Move cursor')
+    helpStr = '^S: Save    ^Q/^X: Quit    ^R: Reset    ENTER/SPACE: Select    TAB: Switch Constant    Arrows: Move cursor    ^A/^D: (De)select by pattern    ^N: Invert    ^Y: Copy from constant'
+    lbHelp.setText(helpStr)
     lbHelp.repaint()
 
-    stdscr.nodelay(True)
+    # Bottom line prompts for the bulk operations
+    prompts = {'select': 'Select by pattern (glob or /regex/): ',
+               'deselect': 'Deselect by pattern (glob or /regex/): ',
+               'copy': 'Copy selection from (shared/session/local): '}
+    promptMode = None
+    promptStr = ''
+
+    showSources = len(getSearchDirs()[0]) > 1
+
+    stdscr.timeout(0)
+    frameTimer = FrameTimer(UI_FPS)
     needRepaint = False
     savedTimeEnd = -1.
     quickSearchTypeEnd = -1.
@@ -343,10 +504,50 @@ def win_main(stdscr):
     quickSearchStr = ''
     
     while True:
+        # Drain all the pending input first, applying it to the model only.
+        # The screen is repainted once the input queue is empty, so a held key
+        # never builds a backlog of repaints.
         c = stdscr.getch()
-
-        if c in KEYS_QUIT:
+        if c != -1:
+            # Got input: drain the rest of it without waiting
+            stdscr.timeout(0)
+
+        if promptMode is not None and c != -1 and c != KEY_RESIZE and c != curses.KEY_RESIZE:
+            msg = None
+            if c == KEY_ESC:
+                promptMode = None
+            elif c in KEYS_BACKSPACE:
+                promptStr = promptStr[:-1]
+            elif c in KEYS_ENTER:
+                if promptMode == 'copy':
+                    name = constName(promptStr)
+                    if name is None:
+                        msg = '--== Unknown constant ==--'
+                    else:
+                        selConsts.copyFrom(PRELOAD_CONSTS.index(name))
+                else:
+                    changed = selConsts.includeByPattern(promptStr, promptMode == 'select')
+                    msg = '--== Bad pattern ==--' if changed is None else ('--== ' + str(changed) + ' changed ==--')
+                promptMode = None
+            elif c >= 32 and c < 127:
+                promptStr += chr(c)
+
+            if msg is not None:
+                savedTimeEnd = getTimestamp() + 1.
+                lastTimeRepaint = -1.
+                lbSaved.setText(msg, False)
+            lbHelp.setText(helpStr if promptMode is None else (prompts[promptMode] + promptStr + '_'), False)
+            needRepaint = True
+        elif c in KEYS_QUIT:
             break
+        elif c == ord('a') + KEY_CTRL_SHIFT or c == ord('d') + KEY_CTRL_SHIFT or c == ord('y') + KEY_CTRL_SHIFT:
+            promptMode = 'select' if c == ord('a') + KEY_CTRL_SHIFT else ('deselect' if c == ord('d') + KEY_CTRL_SHIFT else 'copy')
+            promptStr = ''
+            lbHelp.setText(prompts[promptMode] + '_', False)
+            needRepaint = True
+        elif c == ord('n') + KEY_CTRL_SHIFT:
+            selConsts.invertInclusion()
+            needRepaint = True
         elif c == KEY_TAB:
             selConsts.incSelected()
             selConsts.updateSelectedList()
@@ -371,22 +572,22 @@ def win_main(stdscr):
             selConsts.reset()
             needRepaint = True
         elif c == KEY_HOME:
-            libsPad.selected = 0
+            libsPad.setSelection(0)
             needRepaint = True
         elif c == KEY_END and len(libNames) > 0:
-            libsPad.selected = len(libNames) - 1
+            libsPad.setSelection(len(libNames) - 1)
             needRepaint = True
         elif c == KEY_PGDOWN and len(libNames) > 0:
-            libsPad.selected = (libsPad.selected + int(libsPad.height/4)) % len(libNames)
+            libsPad.setSelection((libsPad.selected + int(libsPad.height/4)) % len(libNames))
             needRepaint = True
         elif c == KEY_PGUP and len(libNames) > 0:
-            libsPad.selected = (libsPad.selected - int(libsPad.height/4)) % len(libNames)
+            libsPad.setSelection((libsPad.selected - int(libsPad.height/4)) % len(libNames))
             needRepaint = True
         elif c == ord('s') + KEY_CTRL_SHIFT:
-            selConsts.saveFiles()
+            savedMsg = savedStr if selConsts.saveFiles() else saveFailedStr
             savedTimeEnd = getTimestamp() + 1. # 1 sec display of "Saved" message
             lastTimeRepaint = -1.
-            lbSaved.setText(savedStr, False)
+            lbSaved.setText(savedMsg, False)
         elif (c >= ord('a') and c <= ord('z')) or (c >= ord('A') and c <= ord('Z')) or (c >= ord('0') and c <= ord('9')) or (c in SYMBOLS):
             # quick search
             if len(quickSearchStr) == 0:
@@ -397,7 +598,37 @@ def win_main(stdscr):
             needRepaint = True
             lbSaved.setText(quickSearchStr, False)
             libsPad.findSelection(quickSearchStr)
-        elif needRepaint or c == KEY_RESIZE or c == curses.KEY_RESIZE or ((savedTimeEnd > 0 or quickSearchTypeEnd > 0) and getTimestamp() - lastTimeRepaint > 0.5):
+        elif c == KEY_RESIZE or c == curses.KEY_RESIZE:
+            needRepaint = True
+        elif c == -1:
+            # Merge the libs discovered in background
+            if loader is not None and not loader.done:
+                newLibs = loader.fetch()
+                if len(newLibs) > 0:
+                    libsPad.mergeLibs(newLibs, set(selConsts.getCurTokens()))
+                    needRepaint = True
+                if loader.done:
+                    needRepaint = True
+
+            if needRepaint:
+                # With several lib dirs, show where the selected lib comes from
+                headStr = '_Libraries_'
+                if loader is not None and not loader.done:
+                    headStr += '(scanning..._' + str(len(libNames)) + '_found)_'
+                if showSources and libsPad.selected < len(libNames):
+                    headStr += '[' + libSources.get(libNames[libsPad.selected], '') + ']_'
+                lbHeadLibs.setText(headStr, False)
+
+            # No more input: render at most one frame per 1/UI_FPS secs
+            # The waits are done by getch() to wake up as soon as a key is pressed
+            if not (needRepaint or ((savedTimeEnd > 0 or quickSearchTypeEnd > 0) and getTimestamp() - lastTimeRepaint > 0.5)):
+                stdscr.timeout(max(int(frameTimer.interval*1000), 1))
+                continue
+            if not frameTimer.frameDue():
+                stdscr.timeout(frameTimer.msToNextFrame())
+                continue
+
+            frameTimer.beginFrame()
             try:
                 stdscr.clear()
                 h,w  = stdscr.getmaxyx()
@@ -427,7 +658,7 @@ def win_main(stdscr):
                         lastTimeRepaint = -1.
                         needRepaint = True
                     else:
-                        lbSaved.relayout(w - 3 - len(savedStr), h - 4, len(savedStr))
+                        lbSaved.relayout(w - 3 - len(lbSaved.text), h - 4, len(lbSaved.text))
                         lbSaved.repaint()
                         lastTimeRepaint = getTimestamp()
                 if quickSearchTypeEnd > 0:
@@ -443,37 +674,121 @@ def win_main(stdscr):
 
             except:
                 needRepaint = True
+            frameTimer.endFrame()
+
+    return frameTimer
+
+# *************************************************************************
+PRELOAD_CONSTS = ['shared_preload_libraries', 'session_preload_libraries', 'local_preload_libraries']
+
+def isPreloadConstLine(l):
+    ls = l.strip()
+    for name in PRELOAD_CONSTS:
+        if ls.startswith(name):
+            return True
+    return False
+# *************************************************************************
+# Returns (mtime, size, hash) of the file or None if it doesn't exist
+def fileSignature(fname):
+    try:
+        st = os.stat(fname)
+        with open(fname, 'rb') as f:
+            return (st.st_mtime_ns, st.st_size, hashlib.sha1(f.read()).hexdigest())
+    except FileNotFoundError:
+        return None
+# *************************************************************************
+# Safe read-modify-write of a config file shared with concurrent writers
+# (other pglib instances, ALTER SYSTEM).
+# updateFunc gets the current file lines and returns the new ones.
+# The file is locked with an fcntl advisory lock for the whole cycle, and its
+# signature is verified right before the new contents are atomically renamed
+# in place. If the file was changed meanwhile, updateFunc is re-applied
+# to the fresh contents (so the concurrent changes are merged, not lost).
+# Returns True on success.
+def rewriteConfigFile(fname, updateFunc):
+    # Rewrite the real file: a symlinked config stays a symlink
+    fname = os.path.realpath(fname)
+    tmpName = fname + '.pglib.' + str(os.getpid()) + '.tmp'
+
+    conflicts = 0
+    while conflicts < WRITE_RETRIES:
+        if conflicts > 0:
+            # Don't hold the lock while waiting
+            time.sleep(WRITE_RETRY_DELAY*conflicts)
+
+        with open(fname, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+
+            # The file could be replaced by another pglib while we were waiting
+            # for the lock. It's not a conflict, just lock the new one.
+            try:
+                if os.fstat(f.fileno()).st_ino != os.stat(fname).st_ino:
+                    continue
+            except FileNotFoundError:
+                continue
+
+            # The signature of exactly what is read from the locked file
+            st = os.fstat(f.fileno())
+            raw = os.pread(f.fileno(), st.st_size, 0)
+            sig = (st.st_mtime_ns, st.st_size, hashlib.sha1(raw).hexdigest())
+            data = updateFunc(io.StringIO(raw.decode(f.encoding), newline=None).readlines())
 
+            try:
+                with open(tmpName, 'w') as ff:
+                    ff.writelines(data)
+                    ff.flush()
+                    os.fsync(ff.fileno())
+                os.chmod(tmpName, st.st_mode & 0o7777)
+                # E.g. for 'sudo pglib.py' the file must stay owned by postgres
+                os.chown(tmpName, st.st_uid, st.st_gid)
+                inPlace = False
+            except OSError:
+                # Can't create the temp file or keep the owner:
+                # fall back to writing in place (still locked)
+                try:
+                    os.remove(tmpName)
+                except OSError:
+                    pass
+                inPlace = True
+
+            # Compare-and-swap: commit only if nobody changed the file since we've read it
+            if fileSignature(fname) != sig:
+                if not inPlace:
+                    os.remove(tmpName)
+                conflicts += 1
+                continue
+
+            if inPlace:
+                f.truncate(0)
+                f.writelines(data)
+                f.flush()
+                os.fsync(f.fileno())
+            else:
+                os.replace(tmpName, fname)
+            return True
+
+    return False
 # *************************************************************************
 def saveCurrentConfigs():
-    data = []
-    with open(postgresql_auto_conf, 'r') as f:
-        for l in f.readlines():
-            ls = l.strip()
-            if not ls.startswith('shared_preload_libraries') and not ls.startswith('session_preload_libraries') and not ls.startswith('local_preload_libraries'):
-                data.append(l)
-                
-    data.append('shared_preload_libraries = \'' + libs_shared + '\'\n')
-    data.append('session_preload_libraries = \'' + libs_session + '\'\n')
-    data.append('local_preload_libraries = \'' + libs_local + '\'\n')
+    constLines = ['shared_preload_libraries = \'' + libs_shared + '\'\n',
+                  'session_preload_libraries = \'' + libs_session + '\'\n',
+                  'local_preload_libraries = \'' + libs_local + '\'\n']
 
-    with open(postgresql_auto_conf, 'w') as f:
-        f.writelines(data)
+    if not rewriteConfigFile(postgresql_auto_conf, lambda lines: [l for l in lines if not isPreloadConstLine(l)] + constLines):
+        return False
     
     # Save last call
-    with open(os.path.expanduser(lastFile), 'w') as f:
-        f.write(postgresql_auto_conf + '\n')
-        f.write('shared_preload_libraries = \'' + libs_shared + '\'\n')
-        f.write('session_preload_libraries = \'' + libs_session + '\'\n')
-        f.write('local_preload_libraries = \'' + libs_local + '\'\n')
+    return rewriteConfigFile(os.path.expanduser(lastFile), lambda lines: [postgresql_auto_conf + '\n'] + constLines)
 # *************************************************************************
 def readConstsFromConfig(fname):
-    if not os.path.isfile(fname):
+    if fname is None or not os.path.isfile(fname):
         return
     
     global libs_shared
     global libs_session
     global libs_local
+    global dynamic_library_path
+    global extension_control_path
 
     with open(fname, 'r') as f:
         for ln in f.readlines():
@@ -492,36 +807,358 @@ def readConstsFromConfig(fname):
                 libs_session = value
             elif name == 'local_preload_libraries':
                 libs_local = value
+            elif name == 'dynamic_library_path':
+                dynamic_library_path = value
+            elif name == 'extension_control_path':
+                extension_control_path = value
 # *************************************************************************
-def readFiles():
-    global libNames
-    global includedLibs
-    libNames = []
-    includedLibs = []
-    
-    # Get libs list
-    sosList = [os.path.split(l.strip())[1] for l in os.popen('ls ' + libdir + '/*.so').readlines()]
-    for ln in os.popen('ls ' + sharedir + '/extension/*.control').readlines():
-        l = os.path.split(ln.strip())[1]
-        libName = l[:l.rfind('.')]
-        if libName + '.so' in sosList:
-            libNames.append(libName)
-            includedLibs.append(False)
-    
-    # Read config files
+# Returns directory mtime or -1 if it can't be accessed
+def dirMTime(d):
+    try:
+        return os.stat(d).st_mtime_ns
+    except OSError:
+        return -1
+# *************************************************************************
+# Splits a colon separated search path value into the dirs list, substituting
+# the macro (like '$libdir') at the beginning of an element
+def splitSearchPath(value, macro, macroDir):
+    res = []
+    for p in value.split(':'):
+        p = p.strip()
+        if p.startswith(macro):
+            p = macroDir + p[len(macro):]
+        if len(p) > 0 and p not in res:
+            res.append(p)
+    return res
+
+# Returns the lib dirs and the extension (control files) dirs in the search
+# precedence order, according to dynamic_library_path and extension_control_path
+def getSearchDirs():
+    libDirs = splitSearchPath(dynamic_library_path, '$libdir', libdir)
+    if len(libDirs) == 0:
+        libDirs = [libdir]
+
+    extDirs = []
+    for p in splitSearchPath(extension_control_path, '$system', sharedir):
+        # The control files are in the 'extension' subdir of a path element,
+        # but let's also accept the control files dir itself
+        if os.path.isdir(os.path.join(p, 'extension')):
+            p = os.path.join(p, 'extension')
+        if p not in extDirs:
+            extDirs.append(p)
+    if len(extDirs) == 0:
+        extDirs = [os.path.join(sharedir, 'extension')]
+
+    return libDirs, extDirs
+# *************************************************************************
+# Lists the names of the files with the given suffix in the dir (suffix cut).
+# found(names) is called for each chunk of names as soon as it's read.
+# The cached (mtime, names) result is reused if the dir wasn't changed since.
+# Returns the (mtime, names) result.
+def scanDir(path, suffix, cache, found):
+    # Take mtime before scanning: a change during the scan makes the result stale
+    mtime = dirMTime(path)
+    cached = cache.get((suffix, path))
+    if cached is not None and mtime != -1 and cached[0] == mtime:
+        found(cached[1])
+        return cached
+
+    names = []
+    chunkStart = 0
+    try:
+        with os.scandir(path) as it:
+            for e in it:
+                if e.name.endswith(suffix):
+                    names.append(e.name[:-len(suffix)])
+                    if len(names) - chunkStart >= SCAN_CHUNK:
+                        found(names[chunkStart:])
+                        chunkStart = len(names)
+    except OSError:
+        pass
+    found(names[chunkStart:])
+    return (mtime, names)
+# *************************************************************************
+# Yields (name, lib dir) for the extensions having both .control and .so
+# files in the order they are found. All the dirs are scanned concurrently,
+# each one independently cached. Like in PostgreSQL, a lib in a dir listed
+# earlier in dynamic_library_path shadows the same lib in the later dirs,
+# so a name is yielded again if it's found later in a higher precedence dir.
+# The per-dir scan results are put to newCache.
+def iterLibSources(libDirs, extDirs, cache, newCache):
+    # Imported here: not needed for shell completion
+    import queue
+    import threading
+
+    found = queue.Queue()
+    jobs = queue.Queue()
+    for j in [('.so', i, d) for i, d in enumerate(libDirs)] + [('.control', i, d) for i, d in enumerate(extDirs)]:
+        jobs.put(j)
+    jobsCount = jobs.qsize()
+
+    def scanWorker():
+        while True:
+            try:
+                suffix, ind, path = jobs.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                newCache[(suffix, path)] = scanDir(path, suffix, cache, lambda names: found.put((suffix, ind, names)))
+            finally:
+                found.put(None)
+
+    # Daemon threads: quitting must not wait for a slow (e.g. networked) dir scan
+    for i in range(min(jobsCount, SCAN_THREADS)):
+        threading.Thread(target=scanWorker, daemon=True).start()
+
+    sosList = {} # name -> lib dir index
+    controlsList = set()
+    jobsLeft = jobsCount
+    while jobsLeft > 0:
+        item = found.get()
+        if item is None:
+            jobsLeft -= 1
+            continue
+
+        suffix, ind, names = item
+        for libName in names:
+            if suffix == '.so':
+                if libName in sosList and sosList[libName] <= ind:
+                    continue
+                sosList[libName] = ind
+                if libName in controlsList:
+                    yield libName, libDirs[ind]
+            elif libName not in controlsList:
+                controlsList.add(libName)
+                if libName in sosList:
+                    yield libName, libDirs[sosList[libName]]
+# *************************************************************************
+# Catalog index: the extensions search dirs, the found libs and the per-dir
+# scan results persisted in catalogFile. Used by shell completion to avoid
+# running the full discovery (which + pg_config) for every request, and to
+# rescan only the changed dirs.
+# Format:
+#   libdirs<TAB><dir>:<dir>...
+#   extdirs<TAB><dir>:<dir>...
+#   names                                     followed by all the found libs, sorted
+#   dir<TAB><suffix><TAB><mtime><TAB><path>   followed by the dir files names, per dir
+# Returns (lib dirs, ext dirs, sorted names, the per-dir part text) or None
+def readCatalog():
+    try:
+        with open(os.path.expanduser(catalogFile), 'r') as f:
+            text = f.read()
+        head, sep, dirsPart = text.partition('\ndir\t')
+        lines = head.split('\n')
+        if not lines[0].startswith('libdirs\t') or not lines[1].startswith('extdirs\t') or lines[2] != 'names':
+            return None
+        return lines[0][len('libdirs\t'):].split(':'), lines[1][len('extdirs\t'):].split(':'), [l for l in lines[3:] if len(l) > 0], sep + dirsPart
+    except (OSError, IndexError):
+        return None
+
+# Returns (lib dirs, ext dirs, sorted names, {(suffix, dir): mtime}) or None.
+# Quick: the per-dir names lists are not parsed.
+def loadCatalogIndex():
+    catalog = readCatalog()
+    if catalog is None:
+        return None
+    try:
+        mtimes = dict([((suffix, path), int(mtime)) for suffix, mtime, path in re.findall(r'^dir\t([^\t\n]*)\t([^\t\n]*)\t([^\n]*)$', catalog[3], re.M)])
+    except ValueError:
+        return None
+    return catalog[0], catalog[1], catalog[2], mtimes
+
+# Returns (lib dirs, ext dirs, {(suffix, dir): (mtime, names)}) or None
+def loadCatalog():
+    catalog = readCatalog()
+    if catalog is None:
+        return None
+
+    cache = {}
+    names = None
+    try:
+        for l in catalog[3].split('\n'):
+            if l.startswith('dir\t'):
+                _, suffix, mtime, path = l.split('\t', 3)
+                names = []
+                cache[(suffix, path)] = (int(mtime), names)
+            elif len(l) > 0:
+                names.append(l)
+    except (ValueError, AttributeError):
+        return None
+    return catalog[0], catalog[1], cache
+
+def saveCatalog(libDirs, extDirs, cache, allNames):
+    data = ['libdirs\t' + ':'.join(libDirs) + '\n', 'extdirs\t' + ':'.join(extDirs) + '\n', 'names\n'] + [n + '\n' for n in allNames]
+    for (suffix, path), (mtime, names) in cache.items():
+        data.append('dir\t' + suffix + '\t' + str(mtime) + '\t' + path + '\n')
+        data += [n + '\n' for n in names]
+    try:
+        rewriteConfigFile(os.path.expanduser(catalogFile), lambda lines: data)
+    except OSError:
+        pass # The catalog is just a cache
+
+# Scans the dirs (only the changed ones actually), updates the catalog and
+# returns the {lib name: lib dir} dict
+def updateCatalog(libDirs, extDirs):
+    catalog = loadCatalog()
+    cache = {} if catalog is None else catalog[2]
+    newCache = {}
+    res = dict(iterLibSources(libDirs, extDirs, cache, newCache))
+    if catalog is None or catalog[0] != libDirs or catalog[1] != extDirs or newCache != cache:
+        saveCatalog(libDirs, extDirs, newCache, sorted(res))
+    return res
+
+# Returns sorted extension names, from the catalog if it's up to date
+def getCatalogNames():
+    index = loadCatalogIndex()
+    if index is not None:
+        libDirs, extDirs, names, mtimes = index
+        # A missing dir stays fresh (-1) until it appears
+        if len(mtimes) == len(libDirs) + len(extDirs) and all([dirMTime(p) == mt for (suffix, p), mt in mtimes.items()]):
+            return names
+        # Stale: in-process rescan of the changed dirs
+        return sorted(updateCatalog(libDirs, extDirs))
+
+    # No catalog yet: full discovery, quietly
+    try:
+        with redirect_stdout(io.StringIO()):
+            gatherSystemInfo()
+            readConfigConsts()
+    except SystemExit:
+        return []
+    libDirs, extDirs = getSearchDirs()
+    return sorted(updateCatalog(libDirs, extDirs))
+
+# Returns the names starting with prefix. The names list is sorted.
+def findByPrefix(names, prefix):
+    res = []
+    i = bisect.bisect_left(names, prefix)
+    while i < len(names) and names[i].startswith(prefix):
+        res.append(names[i])
+        i += 1
+    return res
+# *************************************************************************
+# Discovers the installed extensions in a background thread, streaming them
+# to the UI in batches (so the UI is shown before the discovery is finished).
+# Batch items are (name, lib dir).
+class LibsLoader:
+    BATCH_SIZE = 64
+    BATCH_TIME = 0.05
+
+    def __init__(self, libDirs, extDirs):
+        self.libDirs = libDirs
+        self.extDirs = extDirs
+        # Imported here: not needed for shell completion
+        import queue
+        import threading
+
+        self.queue = queue.Queue()
+        self.queueEmpty = queue.Empty
+        self.done = False
+        self.catalogUpdate = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        catalog = loadCatalog()
+        cache = {} if catalog is None else catalog[2]
+        newCache = {}
+        sources = {}
+        batch = []
+        batchStart = getTimestamp()
+        for lib in iterLibSources(self.libDirs, self.extDirs, cache, newCache):
+            sources[lib[0]] = lib[1]
+            batch.append(lib)
+            if len(batch) >= LibsLoader.BATCH_SIZE or getTimestamp() - batchStart >= LibsLoader.BATCH_TIME:
+                self.queue.put(batch)
+                batch = []
+                batchStart = getTimestamp()
+
+        if catalog is None or catalog[0] != self.libDirs or catalog[1] != self.extDirs or newCache != cache:
+            self.catalogUpdate = (newCache, sorted(sources))
+        if len(batch) > 0:
+            self.queue.put(batch)
+        self.queue.put(None)
+
+    # Saves the scan results to the catalog. Called from the main thread: the
+    # daemon thread can be killed on exit in the middle of writing the file.
+    # If the scan isn't finished shortly, the catalog is left as is.
+    def saveCatalog(self, timeout=0.2):
+        self.thread.join(timeout)
+        if not self.thread.is_alive() and self.catalogUpdate is not None:
+            saveCatalog(self.libDirs, self.extDirs, *self.catalogUpdate)
+            self.catalogUpdate = None
+
+    # Returns all the libs discovered since the last call (without waiting)
+    def fetch(self):
+        res = []
+        while not self.done:
+            try:
+                batch = self.queue.get_nowait()
+            except self.queueEmpty:
+                break
+            if batch is None:
+                self.done = True
+            else:
+                res += batch
+        return res
+# *************************************************************************
+def readConfigConsts():
     global libs_shared
     global libs_session
     global libs_local
+    global dynamic_library_path
+    global extension_control_path
 
     libs_shared = ''
     libs_session = ''
     libs_local = ''
+    dynamic_library_path = '$libdir'
+    extension_control_path = '$system'
 
     readConstsFromConfig(postgresql_conf)
     readConstsFromConfig(postgresql_auto_conf)
+# *************************************************************************
+def readFiles():
+    global libNames
+    global includedLibs
+    global libSources
+    
+    # Read config files (search paths are there too)
+    readConfigConsts()
+
+    # Get libs list
+    libSources = updateCatalog(*getSearchDirs())
+    libNames = sorted(libSources)
+    includedLibs = [False]*len(libNames)
     
     return True
 # *************************************************************************
+# Prints the extensions search dirs and the shadowed libs (for --info)
+def printSearchDirs():
+    readConfigConsts()
+    libDirs, extDirs = getSearchDirs()
+
+    print('\nLibraries search path (dynamic_library_path = \'' + dynamic_library_path + '\'):')
+    for d in libDirs:
+        print('   ' + d + ('' if os.path.isdir(d) else ' (does not exist)'))
+    print('Extensions search path (extension_control_path = \'' + extension_control_path + '\'):')
+    for d in extDirs:
+        print('   ' + d + ('' if os.path.isdir(d) else ' (does not exist)'))
+
+    cache = {}
+    sources = dict(iterLibSources(libDirs, extDirs, {}, cache))
+    dirLibs = [(d, set(cache[('.so', d)][1])) for d in libDirs]
+    shadowed = []
+    for n in sorted(sources):
+        dirs = [d for d, libs in dirLibs if n in libs]
+        if len(dirs) > 1:
+            shadowed.append(n + ': ' + dirs[0] + ' (shadows ' + ', '.join(dirs[1:]) + ')')
+    print('\n' + str(len(sources)) + ' extensions found, ' + str(len(shadowed)) + ' shadowed')
+    for s in shadowed:
+        print('   ' + s)
+# *************************************************************************
 def doSaveLast():
     print('Saving last config...')
     confname = os.path.expanduser(lastFile)
@@ -530,25 +1167,118 @@ def doSaveLast():
         return
 
     with open(confname, 'r') as f:
+        fcntl.flock(f, fcntl.LOCK_SH)
         lastConfig = f.readlines()
-        data = []
-        if os.path.exists(lastConfig[0].strip()):
-            with open(lastConfig[0].strip(), 'r') as ff:
-                for l in ff.readlines():
-                    ls = l.strip()
-                    if not ls.startswith('shared_preload_libraries') and not ls.startswith('session_preload_libraries') and not ls.startswith('local_preload_libraries'):
-                        data.append(l)
-
-        for l in lastConfig[1:]:
-            data.append(l)
-            print(l.strip())
-
-        with open(lastConfig[0].strip(), 'w') as ff:
-            ff.writelines(data)
+
+    for l in lastConfig[1:]:
+        print(l.strip())
+
+    if not rewriteConfigFile(lastConfig[0].strip(), lambda lines: [l for l in lines if not isPreloadConstLine(l)] + lastConfig[1:]):
+        print('Failed to save: ' + lastConfig[0].strip() + ' is being changed concurrently')
+        return
     
     print('Done')
 
 # *************************************************************************
+# Returns full constant name for 'shared'/'session'/'local' (or the full name itself)
+def constName(name):
+    name = name.strip().lower()
+    for c in PRELOAD_CONSTS:
+        if name == c or name + '_preload_libraries' == c:
+            return c
+    return None
+# *************************************************************************
+def exitInvalidSetValue(value):
+    print('Invalid --set value: \'' + value + '\'. Expected --set <shared|session|local>=<lib>[,<lib>...]')
+    exit(1)
+
+# Unless forced, only the installed libs (or the ones already listed in the
+# constant) are accepted: a typo in shared_preload_libraries stops the server
+def doSet(assignments, force=False):
+    global libs_shared
+    global libs_session
+    global libs_local
+
+    gatherSystemInfo()
+    if not readFiles():
+        exit(1)
+
+    installed = set(libNames)
+    current = {'shared_preload_libraries': libs_shared, 'session_preload_libraries': libs_session, 'local_preload_libraries': libs_local}
+    unknown = []
+    for a in assignments:
+        splitP = a.find('=')
+        name = None if splitP <= 0 else constName(a[:splitP])
+        if name is None:
+            exitInvalidSetValue(a)
+
+        tokens = [t.strip() for t in a[splitP + 1:].split(',') if len(t.strip()) > 0]
+        listed = [t.strip() for t in current[name].split(',')]
+        unknown += [t for t in tokens if t not in installed and t not in listed and t not in unknown]
+
+        value = ', '.join(tokens)
+        if name == 'shared_preload_libraries':
+            libs_shared = value
+        elif name == 'session_preload_libraries':
+            libs_session = value
+        else:
+            libs_local = value
+
+    if len(unknown) > 0 and not force:
+        print('Not installed: ' + ', '.join(unknown) + '. Nothing is saved, use --force to save anyway.')
+        exit(1)
+
+    if not saveCurrentConfigs():
+        print('Failed to save: ' + postgresql_auto_conf + ' is being changed concurrently')
+        exit(1)
+
+    print('shared_preload_libraries = \'' + libs_shared + '\'')
+    print('session_preload_libraries = \'' + libs_session + '\'')
+    print('local_preload_libraries = \'' + libs_local + '\'')
+# *************************************************************************
+# Shell completion: prints the candidates for the word being completed
+def doComplete(word):
+    if word.startswith('-'):
+        for o in ['--help', '--last', '--info', '--version', '--set', '--force', '--fps=', '--frame-stats', '--pgdata=', '--pginstall=', '--pgconfig=']:
+            if o.startswith(word):
+                print(o)
+        return
+
+    splitP = word.find('=')
+    if splitP < 0:
+        for c in ['shared=', 'session=', 'local=']:
+            if c.startswith(word.lower()):
+                print(c)
+        return
+
+    if constName(word[:splitP]) is None:
+        return
+
+    # Complete the last lib of a comma separated list, skipping already listed ones
+    head = word[:max(word.rfind(','), splitP) + 1]
+    listed = [t.strip() for t in head[splitP + 1:].split(',')]
+    for n in findByPrefix(getCatalogNames(), word[len(head):].strip()):
+        if n not in listed:
+            print(head + n)
+# *************************************************************************
+def printCompletionScript():
+    fname = os.path.basename(__file__)
+    print('_pglib()\n'
+          '{\n'
+          '    local cur=${COMP_WORDS[COMP_CWORD]}\n'
+          '    local line=${COMP_LINE:0:$COMP_POINT}\n'
+          '    local word=${line##*[[:space:]]}\n'
+          '    local IFS=$\'\\n\'\n'
+          '    COMPREPLY=( $("${COMP_WORDS[0]}" --complete "$word" 2>/dev/null) )\n'
+          '    # Only the part after the last COMP_WORDBREAKS char (e.g. \'=\') gets replaced\n'
+          '    local strip=${word%"$cur"}\n'
+          '    COMPREPLY=( "${COMPREPLY[@]#"$strip"}" )\n'
+          '    if [[ ${#COMPREPLY[@]} -eq 1 && ${COMPREPLY[0]} == *= ]]; then\n'
+          '        compopt -o nospace 2>/dev/null\n'
+          '    fi\n'
+          '}\n'
+          'complete -F _pglib ' + ('pglib ' if fname != 'pglib' else '') + fname)
+# *************************************************************************
 def firstNonNone(lst):
     for l in lst:
         if l is not None:
@@ -709,13 +1439,22 @@ def gatherSystemInfo(verbose=False):
 def printHelp():
     fname = os.path.basename(__file__)
     print('Usage:')
-    print('\t' + fname + ' [<option>] [--pgdata=<PGDATA>] [--pginstall=<PGINSTALL>] [--pgconfig=<PGCONFIG>]')
+    print('\t' + fname + ' [<option>] [--pgdata=<PGDATA>] [--pginstall=<PGINSTALL>] [--pgconfig=<PGCONFIG>] [--fps=<N>] [--frame-stats]')
     print('Options:')
     print('\t --help       : Print this help.')
     print('\t --last       : Rewrite last saved config. No UI.')
     print('\t --info       : Gather info about system, print it and exit.')
     print('\t                Use it as diagnostics in case of problems.')
     print('\t --version    : Print program version.')
+    print('\t --fps=<N>    : UI frame rate cap (default ' + str(UI_FPS) + ', max ' + str(UI_FPS_MAX) + '). Lower it for slow links.')
+    print('\t --frame-stats: Print UI frames count and render times on exit.')
+    print('\t --set <shared|session|local>=<lib>[,<lib>...]')
+    print('\t              : Set the constant without UI. Can be repeated. Only the installed libs\n'
+          '\t                are accepted unless --force is given.')
+    print('\t --completion-script')
+    print('\t              : Print bash completion script. Use it as:')
+    print('\t                eval "$(' + fname + ' --completion-script)"')
+    print('\t                (for zsh run \'autoload -U bashcompinit && bashcompinit\' first)')
     print('\nDisplays installed extensions for existing PostgreSQL instance and allows to\n'
           'select them for (shared/session/local)_preload_libraries. The resulting constants\n'
           'are saved to postgresql.auto.conf.')
@@ -736,7 +1475,9 @@ def printHelp():
           '   PGDATA is read either from the corresponding parameter/environment constant or\n'
           '   from the data_directory value of postgresql.conf file if PGCONFIG is given.')
     print('2. lib/share directories. These are requested from pg_config which is expected to\n'
-          '   be found either in PGINSTALL/bin or somewhere in the system $PATH.')
+          '   be found either in PGINSTALL/bin or somewhere in the system $PATH.\n'
+          '   If dynamic_library_path / extension_control_path are set in the config files,\n'
+          '   all the directories listed there are searched as well.')
     print('Use --info option to see which paths will be used for your system.')
 # *************************************************************************
 def parseArgs(args):
@@ -755,10 +1496,32 @@ def parseArgs(args):
         print(APP_VERSION)
         exit()
     
+    if args[0].lower() == '--complete':
+        doComplete(args[1] if len(args) > 1 else '')
+        exit()
+
+    if args[0].lower() == '--completion-script':
+        printCompletionScript()
+        exit()
+    
     if args[0].lower() == '--info':
         doPrintInfo = True
 
-    for arg in args:
+    setArgs = []
+    forceSet = False
+    for i, arg in enumerate(args):
+        if i > 0 and args[i - 1].lower() == '--set':
+            setArgs.append(arg)
+            continue
+        if arg.lower() == '--set' and i == len(args) - 1:
+            exitInvalidSetValue('')
+        if arg.lower() == '--force':
+            forceSet = True
+            continue
+        if arg.lower() == '--frame-stats':
+            global FRAME_STATS
+            FRAME_STATS = True
+            continue
         splitP = arg.find('=')
         if splitP <= 0:
             continue
@@ -774,9 +1537,23 @@ def parseArgs(args):
         elif name == '--pgconfig':
             global PGCONFIG
             PGCONFIG = value            
+        elif name == '--set':
+            exitInvalidSetValue(value)
+        elif name == '--fps':
+            global UI_FPS
+            try:
+                UI_FPS = min(max(int(value), 1), UI_FPS_MAX)
+            except ValueError:
+                print('Invalid --fps value: \'' + value + '\'')
+                exit(1)
     
     if doPrintInfo:
         gatherSystemInfo(True)
+        printSearchDirs()
+        exit()
+
+    if len(setArgs) > 0:
+        doSet(setArgs, forceSet)
         exit()
 # *************************************************************************
 if __name__ == '__main__':
@@ -784,14 +1561,22 @@ if __name__ == '__main__':
         parseArgs(sys.argv[1:])
     
     gatherSystemInfo()
-        
-    if not readFiles():
-        exit(1)
+    readConfigConsts()
+
+    # The libs list is populated in background while the UI is already shown
+    loader = LibsLoader(*getSearchDirs())
+    loader.start()
     
     stdscr = curses.initscr()
     
     curses.raw(True)
-    curses.wrapper(win_main)
+    try:
+        frameTimer = curses.wrapper(win_main, loader)
+    finally:
+        loader.saveCatalog()
     
     curses.reset_shell_mode()
+
+    if FRAME_STATS:
+        print(frameTimer.statsStr())
     
\ No newline at end of file